@@ -5,11 +5,11 @@ from http.server import BaseHTTPRequestHandler
 
 class ApiEndpoint(BaseHTTPRequestHandler):
     """
-    Responds to web requests for health and stats checks. Set parser_stats, shipper_stats, shipper, and fetcher before using!
+    Responds to web requests for health and stats checks. Set parser_stats, shipper_stats, shippers, and fetcher before using!
     """
     parser_stats = None
     shipper_stats = None
-    shipper = None
+    shippers = None
     fetcher = None
 
     def do_GET(self) -> None:
@@ -35,7 +35,7 @@ class ApiEndpoint(BaseHTTPRequestHandler):
         shipper["last_document_indexed_at"] = str(shipper["last_document_indexed_at"])
         stats = dict(parser=parser, shipper=shipper)
         stats['queues'] = dict()
-        stats['queues']['shipper'] = dict(description='Records waiting to be sent to Elasticsearch', length=self.shipper.record_queue.qsize())
+        stats['queues']['shipper'] = dict(description='Records waiting to be sent to Elasticsearch', length=self.shippers[0].record_queue.qsize())
         stats['queues']['files'] = dict(description='Files waiting to be processed', length=self.fetcher.to_do.qsize())
         response = bytes(json.dumps(stats), 'utf-8')
         
@@ -50,7 +50,8 @@ class ApiEndpoint(BaseHTTPRequestHandler):
         Send health information, with a 500 if the service is unhealthy
         """
         response = dict()
-        response["elasticsearch_connected"] = self.shipper.healthy
+        # the shippers share a client, but check them all rather than assume they agree
+        response["elasticsearch_connected"] = all(shipper.healthy for shipper in self.shippers)
         response["s3_connected"] = self.fetcher.healthy
         if response["elasticsearch_connected"] and response["s3_connected"]:
             response["status"] = "UP"
@@ -61,7 +62,7 @@ class ApiEndpoint(BaseHTTPRequestHandler):
             self.end_headers()
         else:
             response["status"] = "DOWN"
-            response = bytes(json.dumps(stats), 'utf-8')
+            response = bytes(json.dumps(response), 'utf-8')
             self.send_error(500, explain=response)
             self.send_header("Content-Length", str(len(response)))
             self.end_headers()
@@ -42,11 +42,17 @@ class ElasticsearchShipper:
             record = self.record_queue.get()
             self.index_record(*record)
 
-    def index_record(self, id_: str, record: typing.Dict) -> None:
+    def index_record(
+        self, id_: str, record: typing.Union[typing.Dict, bytes], timestamp: str = None
+    ) -> None:
         """
-        Index a document into elasticsearch
+        Index a document into elasticsearch.
+        record is either a dict, or a document the parser already serialized to JSON,
+        in which case timestamp must be its @timestamp
         """
-        index = self.figure_index(record)
+        if timestamp is None:
+            timestamp = record["@timestamp"]
+        index = self.figure_index(timestamp)
         try:
             self.es.create(index=index, id=id_, body=record, doc_type='doc')
         except elasticsearch.ConflictError:
@@ -56,14 +62,13 @@ class ElasticsearchShipper:
             # if it failed for an unknown reason, log it and put it back on the queue so we can try again
             self.stats.increment_documents_errored()
             logger.exception("Failed to index document")
-            self.record_queue.put((id_, record))
+            self.record_queue.put((id_, record, timestamp))
         else:
             self.stats.increment_documents_indexed()
             self.stats.document_time()
             logger.debug("Indexing document with id %s", id_)
 
-    def figure_index(self, record: typing.Dict) -> str:
-        ts = record['@timestamp']
+    def figure_index(self, ts: str) -> str:
         if ts.endswith('Z'):
             ts = ts[:-1]
         ts = datetime.datetime.fromisoformat(ts)
@@ -1,14 +1,30 @@
 """
 Retrieves ELB log files
 """
+import asyncio
+import concurrent.futures
+import gzip
 import io
+import itertools
 import logging
+import os
 import pathlib
 import queue
+import threading
+import time
+import typing
+
 import boto3
+import boto3.s3.transfer
 
 logger = logging.Logger(__name__)
 
+# S3 won't delete more keys than this in one request
+DELETE_BATCH_LIMIT = 1000
+
+# every gzip stream starts with these bytes
+GZIP_MAGIC = b"\x1f\x8b"
+
 
 class S3LogFetcher:
     """
@@ -18,6 +34,7 @@ class S3LogFetcher:
     def __init__(
         self,
         bucket,
+        s3_client,
         to_do: queue.Queue,
         done: queue.Queue,
         *,
@@ -25,9 +42,10 @@ class S3LogFetcher:
         processing_prefix: str,
         processed_prefix: str,
         file_batch_size: int = 5,
+        relist_interval: float = 10,
     ) -> None:
         """
-        bucket: the name of the bucket
+        bucket: a boto s3 Bucket
         s3_client: a boto s3 client
         unprocessed_prefix: the prefix in the bucket to look for new logs
         processing_prefix: the prefix in the bucket to put/find processing logs
@@ -35,8 +53,10 @@ class S3LogFetcher:
         to_do: the queue to send work to the log parser
         done: the queue to listen on for finished work
         file_batch_size: how many log files to pull down at a time
+        relist_interval: how many seconds to wait before listing again after a listing finds nothing new
         """
         self.bucket = bucket
+        self.s3_client = s3_client
         self.unprocessed_prefix = unprocessed_prefix
         self.processing_prefix = processing_prefix
         self.processed_prefix = processed_prefix
@@ -44,94 +64,319 @@ class S3LogFetcher:
         self.done = done
         self.file_batch_size = file_batch_size
         self.healthy = True
+        # lazily-paged listing of unprocessed logs, shared between batches
+        self.unprocessed_keys = None
+        # whether the current listing has turned up any logs yet
+        self.listing_found_logs = False
+        # don't start a new listing before this time (from time.monotonic)
+        self.relist_interval = relist_interval
+        self.next_listing_time = 0.0
+        # sources of moved objects, deleted in batches by flush_deletes
+        self._pending_deletes: typing.List[str] = []
+        # every key we've moved but not yet deleted, including ones mid-flush. These are
+        # still in the bucket, so the listing has to skip them or we'd fetch them twice
+        self._undeleted_keys: typing.Set[str] = set()
+        # keys deleted since the current listing started. A page fetched before the
+        # delete can still list them, so they stay hidden until the next listing
+        self._deleted_keys: typing.Set[str] = set()
+        self._delete_lock = threading.Lock()
+        # large logs are fetched as concurrent ranged GETs. Each file in a batch
+        # gets its own ranges, so up to file_batch_size * max_concurrency GETs
+        # can be in flight at once
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=16 * 1024 * 1024,
+            max_concurrency=8,
+            use_threads=True,
+        )
+        # refill the to_do queue once it drops below this, so downloading overlaps parsing
+        self.low_water_mark = max(1, file_batch_size // 2)
+        # set whenever a log finishes, to wake up the fetching loop
+        self.log_finished = threading.Event()
+        # set to ask run() to return
+        self.stopping = threading.Event()
+        # downloads for a batch run concurrently - boto3 clients are threadsafe
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=file_batch_size
+        )
 
     def run(self) -> None:
         """
         Do the work:
-        - first, prime the queue with some logs
-        - then, poll to see when the logs are done
-        - if we can get a log off the done queue, mark it as done
-        - if we get a log off the done queue, get another one for the to_do queue
+        - start a thread to mark logs done as they come off the done queue
+        - keep the to_do queue topped up, fetching more logs whenever it runs low
+        - wait for a log to finish (or a timeout, in case there was nothing to fetch), and repeat
         """
-        while True:
-            if self.to_do.empty():
-                self.enqueue_log(self.file_batch_size)
-            try:
-                finished_log = self.done.get(timeout=1)
-            except queue.Empty:
-                continue
-            try:
-                self.mark_log_processed(finished_log)
-            except Exception as e:
-                # if it fails:
-                #   - log it
-                #   - put it back on the queue, so we can retry
-                #   - mark ourselves unhealthy
-                logger.error(e)
-                self.done.put(finished_log)
-                self.healthy = False
-            else:
-                self.healthy = True
+        threading.Thread(target=self.process_done, daemon=True).start()
+        while not self.stopping.is_set():
+            queued = self.to_do.qsize()
+            if queued < self.low_water_mark:
+                self.enqueue_log(self.file_batch_size - queued)
+            self.wait_for_finished_log()
+
+    def stop(self) -> None:
+        """
+        Ask run() to return once it finishes what it's doing
+        """
+        self.stopping.set()
+        # wake the fetching loop so it sees we're stopping
+        self.log_finished.set()
+
+    def process_done(self) -> None:
+        """
+        Mark logs processed as the parser finishes them, and flush the deletes that generates
+        """
+        while not self.stopping.is_set():
+            finished_log = self.done.get()
+            self.finish_log(finished_log)
+            self.flush_deletes()
+            self.log_finished.set()
+
+    def wait_for_finished_log(self, timeout: float = 1) -> None:
+        """
+        Block until a log finishes processing, or until the timeout passes
+        """
+        self.log_finished.wait(timeout)
+        self.log_finished.clear()
+
+    def finish_log(self, finished_log: str) -> None:
+        """
+        Mark a log the parser is done with as processed.
+        """
+        try:
+            self.mark_log_processed(finished_log)
+        except Exception as e:
+            # if it fails:
+            #   - log it
+            #   - put it back on the queue, so we can retry
+            #   - mark ourselves unhealthy
+            logger.error(e)
+            self.done.put(finished_log)
+            self.healthy = False
+        else:
+            self.healthy = True
 
     def enqueue_log(self, count: int = 1) -> str:
         """
         Download one log from S3, mark it as processing, and return its name.
         If there are no logs to get, return None.
         """
+        if not self.start_listing(self.list_unprocessed_logs):
+            return None
         try:
-            boto_response = self.bucket.objects.filter(
-                MaxKeys=count, Prefix=self.unprocessed_prefix
-            )
+            keys = list(itertools.islice(self.unprocessed_keys, count))
         except Exception:
-            # ignore it and try again later - hopefully someone's checking health
-            logger.exception("Failed listing logs in S3")
-            self.healthy = False
+            self.listing_failed()
             return None
-        else:
-            self.healthy = True
-        boto_response = list(boto_response)
-        for response in boto_response:
-            next_object = response.key
-            processing_name = self.mark_log_processing(next_object)
-            contents = io.BytesIO()
-            self.bucket.download_fileobj(processing_name, contents)
-            contents.seek(0)
-            strings = [line.decode("utf-8") for line in contents.readlines()]
-            self.to_do.put((processing_name, strings),)
+        self.keys_listed(keys, count)
+        futures = [self.executor.submit(self.fetch_log, key) for key in keys]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                log = future.result()
+            except Exception:
+                self.fetch_failed()
+                continue
+            self.to_do.put(log)
 
-    def mark_log_processed(self, logname: str) -> None:
+    def start_listing(self, list_logs: typing.Callable) -> bool:
         """
-        Move a logfile from the processing to the processed prefix.
+        Start a new listing with list_logs, unless we're already partway through one.
+        Returns False if it's too soon to list again.
         """
-        processed_name = self.processed_name_from_processing_name(logname)
-        self.move_object(from_=logname, to=processed_name)
-        return processed_name
+        if self.unprocessed_keys is None:
+            if time.monotonic() < self.next_listing_time:
+                return False
+            # listings are lazy, so every page of the new one is fetched after this
+            with self._delete_lock:
+                self._deleted_keys.clear()
+            self.unprocessed_keys = list_logs()
+            self.listing_found_logs = False
+        return True
 
-    def mark_log_processing(self, logname: str) -> None:
+    def listing_failed(self) -> None:
         """
-        Move a logfile from the unprocessed to the processing prefix.
+        Give up on the current listing
+        """
+        # ignore it and try again later - hopefully someone's checking health
+        logger.exception("Failed listing logs in S3")
+        self.unprocessed_keys = None
+        self.healthy = False
+
+    def keys_listed(self, keys: typing.List[str], count: int) -> None:
+        """
+        Record that we took keys from the listing, when we asked for count of them
+        """
+        self.healthy = True
+        if keys:
+            self.listing_found_logs = True
+        if len(keys) < count:
+            self.end_listing()
+
+    def fetch_failed(self) -> None:
+        """
+        Record that one log in a batch failed to fetch
+        """
+        # one bad log (e.g. another instance already moved it) shouldn't
+        # cost us the rest of the batch
+        logger.exception("Failed fetching log from S3")
+        self.healthy = False
+
+    def end_listing(self) -> None:
+        """
+        We've run off the end of the listing, so start a fresh one next time.
+        If it had nothing new for us, the prefix hasn't changed since we last looked,
+        so hold off on listing it again for a while.
+        """
+        self.unprocessed_keys = None
+        if not self.listing_found_logs:
+            self.next_listing_time = time.monotonic() + self.relist_interval
+
+    def list_unprocessed_logs(self) -> typing.Iterator[str]:
+        """
+        Lazily list the keys under the unprocessed prefix, one page at a time.
+        """
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in self.paginate_unprocessed_logs(paginator):
+            yield from self.unmoved_keys(page)
+
+    def paginate_unprocessed_logs(self, paginator):
+        """
+        Start paging through the unprocessed prefix with a list_objects_v2 paginator
+        """
+        return paginator.paginate(
+            Bucket=self.bucket.name,
+            Prefix=self.unprocessed_prefix,
+            PaginationConfig={"PageSize": 1000},
+        )
+
+    def unmoved_keys(self, page: typing.Dict) -> typing.Iterator[str]:
+        """
+        The keys in a page of a listing, skipping ones we've already moved
+        """
+        for obj in page.get("Contents", []):
+            if not self.is_moved(obj["Key"]):
+                yield obj["Key"]
+
+    def fetch_log(self, key: str) -> (str, typing.Iterable[str]):
+        """
+        Mark a log as processing, then download it.
+        The original is only queued for deletion once the download succeeds, so a
+        failed download leaves the log where the next listing will find it.
         """
         # Note - this is one of the places where a race condition can cause
         # us to process a file more than once
-        processing_name = self.processing_name_from_unprocessed_name(logname)
-        self.move_object(from_=logname, to=processing_name)
-        return processing_name
+        processing_name = self.processing_name_from_unprocessed_name(key)
+        self.bucket.copy(dict(Bucket=self.bucket.name, Key=key), processing_name)
+        try:
+            log = self.download_log(processing_name)
+        except Exception:
+            self.bucket.delete_objects(
+                Delete={"Objects": [{"Key": processing_name}], "Quiet": True}
+            )
+            raise
+        if self.queue_delete(key):
+            self.flush_deletes()
+        return log
+
+    def download_log(self, name: str) -> (str, typing.Iterable[str]):
+        """
+        Download a log from S3 and return an iterator over its lines.
+        Lines are decoded (and gunzipped, for compressed logs) lazily as the parser reads them.
+        """
+        contents = io.BytesIO()
+        self.bucket.download_fileobj(name, contents, Config=self.transfer_config)
+        return name, self.lines_from_buffer(contents)
+
+    def lines_from_buffer(self, contents: io.BytesIO) -> typing.Iterable[str]:
+        """
+        Wrap a freshly-downloaded log for reading line-by-line.
+        """
+        contents.seek(0)
+        # look at the content rather than the name, so we also catch objects stored
+        # gzipped with Content-Encoding: gzip but without a .gz suffix
+        compressed = contents.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        contents.seek(0)
+        if compressed:
+            contents = gzip.GzipFile(fileobj=contents)
+        # split only on \n, like the ALB writes them: universal newlines would also split
+        # on a bare \r inside a field, and the parser gives up on the first bad line
+        return io.TextIOWrapper(contents, encoding="utf-8", newline="\n")
+
+    def mark_log_processed(self, logname: str) -> None:
+        """
+        Move a logfile from the processing to the processed prefix.
+        """
+        processed_name = self.processed_name_from_processing_name(logname)
+        self.move_object(from_=logname, to=processed_name)
+        return processed_name
 
     def move_object(self, from_, to) -> None:
         """
         Move/rename an object within this bucket.
         """
-        # boto doesn't have a move operation, so we need to copy then delete
+        # boto doesn't have a move operation, so we need to copy then delete.
+        # Deletes are batched up, so the old object lingers until the next flush
         self.bucket.copy(dict(Bucket=self.bucket.name, Key=from_), to)
-        delete_request = {"Objects": [{"Key": from_}], "Quiet": True}
-        self.bucket.delete_objects(Delete=delete_request)
+        if self.queue_delete(from_):
+            self.flush_deletes()
+
+    def queue_delete(self, key: str) -> bool:
+        """
+        Queue an object to be deleted on the next flush.
+        Returns True if there's a full batch waiting to be flushed.
+        """
+        with self._delete_lock:
+            self._pending_deletes.append(key)
+            self._undeleted_keys.add(key)
+            return len(self._pending_deletes) >= DELETE_BATCH_LIMIT
+
+    def flush_deletes(self) -> None:
+        """
+        Delete the sources of moved objects, up to DELETE_BATCH_LIMIT per request.
+        """
+        while True:
+            with self._delete_lock:
+                batch = self._pending_deletes[:DELETE_BATCH_LIMIT]
+                del self._pending_deletes[:DELETE_BATCH_LIMIT]
+            if not batch:
+                return
+            delete_request = {"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            try:
+                response = self.bucket.delete_objects(Delete=delete_request)
+            except Exception:
+                # put them back so we can retry on the next flush
+                logger.exception("Failed deleting logs in S3")
+                with self._delete_lock:
+                    self._pending_deletes.extend(batch)
+                self.healthy = False
+                return
+            failed = [error["Key"] for error in response.get("Errors", [])]
+            for error in response.get("Errors", []):
+                logger.error("Failed deleting %s: %s", error["Key"], error["Message"])
+            with self._delete_lock:
+                # failed keys are still in the bucket, so keep skipping them in listings
+                deleted = set(batch) - set(failed)
+                self._undeleted_keys.difference_update(deleted)
+                self._deleted_keys.update(deleted)
+                self._pending_deletes.extend(failed)
+            if failed:
+                # stop here, so we don't spin retrying them - the next flush will
+                self.healthy = False
+                return
+
+    def is_moved(self, key: str) -> bool:
+        """
+        Check whether we've already moved an object, so the listing should skip it.
+        """
+        with self._delete_lock:
+            return key in self._undeleted_keys or key in self._deleted_keys
 
     def processing_name_from_unprocessed_name(self, unprocessed_name: str) -> str:
         """
         Determine the processing name from an unprocessed name
         """
         return replace_prefix(
-            unprocessed_name, self.unprocessed_prefix, self.processed_prefix
+            unprocessed_name, self.unprocessed_prefix, self.processing_prefix
         )
 
     def processed_name_from_processing_name(self, processing_name: str) -> str:
@@ -143,6 +388,108 @@ class S3LogFetcher:
         )
 
 
+class AsyncS3LogFetcher(S3LogFetcher):
+    """
+    Fetches logs from S3 like S3LogFetcher, but lists and downloads them with
+    aiobotocore on an event loop instead of with a thread per download.
+    Requires the optional aiobotocore dependency.
+    """
+
+    def __init__(self, *args, s3_config_options: typing.Dict = None, **kwargs) -> None:
+        """
+        Takes the same arguments as S3LogFetcher, plus
+        s3_config_options: botocore.config.Config options for the aiobotocore client
+        """
+        super().__init__(*args, **kwargs)
+        self.s3_config_options = s3_config_options or {}
+
+    def run(self) -> None:
+        """
+        Do the work, like S3LogFetcher.run, but on an event loop
+        """
+        threading.Thread(target=self.process_done, daemon=True).start()
+        asyncio.run(self._run())
+
+    async def _run(self) -> None:
+        """
+        The same loop as S3LogFetcher.run, with the blocking bits pushed onto threads
+        """
+        # optional dependency, so only import it if we're actually used
+        import aiobotocore.config
+        import aiobotocore.session
+
+        loop = asyncio.get_running_loop()
+        session = aiobotocore.session.get_session()
+        config = aiobotocore.config.AioConfig(**self.s3_config_options)
+        async with session.create_client("s3", config=config) as s3:
+            while not self.stopping.is_set():
+                queued = self.to_do.qsize()
+                if queued < self.low_water_mark:
+                    await self.enqueue_log_async(s3, self.file_batch_size - queued)
+                await loop.run_in_executor(self.executor, self.wait_for_finished_log)
+
+    async def enqueue_log_async(self, s3, count: int = 1) -> None:
+        """
+        Download up to count logs from S3, mark them as processing, and queue them for the parser
+        """
+        loop = asyncio.get_running_loop()
+        if not self.start_listing(lambda: self.list_unprocessed_logs_async(s3)):
+            return
+        keys = []
+        try:
+            async for key in self.unprocessed_keys:
+                keys.append(key)
+                if len(keys) == count:
+                    break
+        except Exception:
+            self.listing_failed()
+            return
+        self.keys_listed(keys, count)
+        # at most count tasks, so this is already bounded by file_batch_size
+        tasks = [asyncio.create_task(self.fetch_log_async(s3, key)) for key in keys]
+        for task in asyncio.as_completed(tasks):
+            try:
+                log = await task
+            except Exception:
+                self.fetch_failed()
+                continue
+            await loop.run_in_executor(self.executor, self.to_do.put, log)
+
+    async def list_unprocessed_logs_async(self, s3) -> typing.AsyncIterator[str]:
+        """
+        Lazily list the keys under the unprocessed prefix, one page at a time.
+        """
+        paginator = s3.get_paginator("list_objects_v2")
+        async for page in self.paginate_unprocessed_logs(paginator):
+            for key in self.unmoved_keys(page):
+                yield key
+
+    async def fetch_log_async(self, s3, key: str) -> (str, typing.Iterable[str]):
+        """
+        Mark a log as processing, then download it, like fetch_log.
+        """
+        # Note - this is one of the places where a race condition can cause
+        # us to process a file more than once
+        processing_name = self.processing_name_from_unprocessed_name(key)
+        await s3.copy_object(
+            Bucket=self.bucket.name,
+            Key=processing_name,
+            CopySource=dict(Bucket=self.bucket.name, Key=key),
+        )
+        try:
+            response = await s3.get_object(Bucket=self.bucket.name, Key=processing_name)
+            contents = io.BytesIO()
+            async with response["Body"] as body:
+                async for chunk in body.iter_chunks(1024 * 1024):
+                    contents.write(chunk)
+        except Exception:
+            await s3.delete_object(Bucket=self.bucket.name, Key=processing_name)
+            raise
+        # the process_done thread flushes after every log, so don't block on a full batch here
+        self.queue_delete(key)
+        return processing_name, self.lines_from_buffer(contents)
+
+
 class LocalLogFetcher:
 
     def __init__(self, input_dir: pathlib.Path, processing_dir: pathlib.Path, done_dir: pathlib.Path, to_do: queue.Queue, done: queue.Queue, file_batch_size: int = 5,):
@@ -152,6 +499,9 @@ class LocalLogFetcher:
         self.to_do = to_do
         self.done = done
         self.file_batch_size = file_batch_size
+        self.healthy = True
+        # set to ask run() to return
+        self.stopping = threading.Event()
 
     def run(self) -> None:
         """
@@ -161,7 +511,7 @@ class LocalLogFetcher:
         - if we can get a log off the done queue, mark it as done
         - if we get a log off the done queue, get another one for the to_do queue
         """
-        while True:
+        while not self.stopping.is_set():
             if self.to_do.empty():
                 self.enqueue_log(self.file_batch_size)
             try:
@@ -181,6 +531,12 @@ class LocalLogFetcher:
             else:
                 self.healthy = True
 
+    def stop(self) -> None:
+        """
+        Ask run() to return once it finishes what it's doing
+        """
+        self.stopping.set()
+
     def enqueue_log(self, count: int = 1) -> str:
         """
         Download one log from S3, mark it as processing, and return its name.
@@ -190,11 +546,12 @@ class LocalLogFetcher:
         # take the first count of them
         # push them to the queue && move them
         filenames = self.input_dir.glob("*.log")
-        for filename in list(filenames)[:self.file_batch_size]:
+        for filename in itertools.islice(filenames, count):
             processing_name = self.mark_log_processing(filename)
-            contents = io.BytesIO()
-            with open(processing_name, "r") as contents:
-                strings = [line for line in contents.readlines()]
+            # one decode for the whole file, rather than per line. Iterating a StringIO
+            # only splits on \n, like the S3 fetcher's newline="\n" TextIOWrapper - unlike
+            # str.splitlines, which also splits on \r and characters like \x1c and \u2028
+            strings = io.StringIO(processing_name.read_text(encoding="utf-8"))
             self.to_do.put((processing_name, strings),)
 
     def mark_log_processed(self, logname: str) -> None:
@@ -202,8 +559,10 @@ class LocalLogFetcher:
         Move a logfile from the processing to the processed prefix.
         """
         processed_name = self.done_dir / logname.name
+        # truncate to save disk space before moving, so the rename atomically
+        # publishes the finished semaphore and a retry can safely redo both steps
+        os.truncate(logname, 0)
         self.move_object(from_=logname, to=processed_name)
-        open(processed_name, "w").close() # truncate to save disk space
         return processed_name
 
     def mark_log_processing(self, logname: pathlib.Path) -> None:
@@ -231,5 +590,5 @@ class LocalLogFetcher:
 def replace_prefix(logname: str, old_prefix: str, new_prefix: str) -> str:
     if not logname.startswith(old_prefix):
         raise ValueError
-    return logname.replace(old_prefix, new_prefix, 1)
+    return new_prefix + logname[len(old_prefix):]
 
@@ -131,6 +131,7 @@ class LogParser:
         file_out_queue: queue.Queue,
         record_out_queue: queue.Queue,
         stats: ParserStats,
+        serializer: typing.Callable[[typing.Dict], bytes] = None,
     ) -> None:
         # where we get files to process
         self.file_in_queue = file_in_queue
@@ -140,6 +141,8 @@ class LogParser:
         self.outbox = record_out_queue
         # where we publish stats
         self.stats = stats
+        # if set, records are serialized once here instead of by the shipper
+        self.serializer = serializer
 
     def run(self) -> None:
         """
@@ -157,12 +160,26 @@ class LogParser:
             except queue.Empty:
                 pass
             if name is not None:
-                self.stats.new_file_time()
-                self.parse_alb_logs(name, lines)
-                self.file_out_queue.put(name)
-                self.stats.increment_files_processed()
+                self.parse_file(name, lines)
 
-    def parse_alb_logs(self, name, lines: typing.List[str]) -> None:
+    def parse_file(self, name, lines: typing.Iterable[str]) -> None:
+        """
+        Parse one log file and mark it done
+        """
+        self.stats.new_file_time()
+        try:
+            self.parse_alb_logs(name, lines)
+        except Exception:
+            # lines are decoded (and gunzipped) as we read them, so a corrupt file
+            # only shows up here. Give up on it like we do on a line that doesn't
+            # match, rather than letting it kill the parser thread - putting it
+            # back would just fail again.
+            self.stats.increment_lines_errored()
+            logger.exception("failed to read %s", name)
+        self.file_out_queue.put(name)
+        self.stats.increment_files_processed()
+
+    def parse_alb_logs(self, name, lines: typing.Iterable[str]) -> None:
         """
         Parse log lines and push their messages to the queue
         """
@@ -193,7 +210,11 @@ class LogParser:
             match = add_metadata(match, line, name_string)
             if match is not None:
                 id_ = generate_id(match)
-                self.outbox.put((id_, match,))
+                if self.serializer is None:
+                    self.outbox.put((id_, match,))
+                else:
+                    # the shipper still needs the timestamp to pick an index
+                    self.outbox.put((id_, self.serializer(match), match["@timestamp"],))
                 self.stats.increment_lines_processed()
             else:
                 self.stats.increment_lines_errored()
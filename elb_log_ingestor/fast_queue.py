@@ -0,0 +1,75 @@
+"""
+A lighter-weight stand-in for queue.Queue for handing work between threads
+"""
+import collections
+import queue
+import threading
+import time
+
+
+class FastQueue:
+    """
+    A FIFO queue with the parts of the queue.Queue interface we use (put, get, empty, full, qsize).
+    deque.popleft is atomic, so get() only takes the lock when it has to wait for an item.
+    Raises queue.Empty and queue.Full, just like queue.Queue.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def put(self, item, block: bool = True, timeout: float = None) -> None:
+        """
+        Put an item on the queue, waiting for space if the queue is bounded and full
+        """
+        with self._not_full:
+            if self.maxsize > 0:
+                if not block and len(self._items) >= self.maxsize:
+                    raise queue.Full
+                if not self._not_full.wait_for(
+                    lambda: len(self._items) < self.maxsize, timeout
+                ):
+                    raise queue.Full
+            self._items.append(item)
+            self._not_empty.notify()
+
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Take an item off the queue, waiting for one if it's empty
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                item = self._items.popleft()
+            except IndexError:
+                pass
+            else:
+                if self.maxsize > 0:
+                    with self._not_full:
+                        self._not_full.notify()
+                return item
+            if not block:
+                raise queue.Empty
+            with self._not_empty:
+                # put() appends under the lock, so checking again here can't miss a notify
+                if self._items:
+                    continue
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._items)
+
+    def qsize(self) -> int:
+        return len(self._items)
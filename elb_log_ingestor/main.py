@@ -6,12 +6,16 @@ import sys
 import threading
 import logging
 
+import boto3
+import botocore.config
 import elasticsearch
+import orjson
 
 from . import api_endpoint
 from . import elasticsearch_shipper
 from . import elb_log_fetcher
 from . import elb_log_parse
+from . import fast_queue
 from . import stats
 
 
@@ -26,25 +30,52 @@ def start_server():
     )
     server_address = get_server_address()
 
-    logs_to_be_processed = queue.Queue()
+    logs_to_be_processed = fast_queue.FastQueue()
     logs_processed = queue.Queue()
-    records = queue.Queue()
+    records = fast_queue.FastQueue()
     file_batch_size = int(os.environ.get("ELB_INGESTOR_FILE_BATCH_SIZE", 5))
+    shipper_count = int(os.environ.get("ELB_INGESTOR_SHIPPER_COUNT", 1))
+    if shipper_count < 1:
+        raise Exception("ELB_INGESTOR_SHIPPER_COUNT must be at least 1")
     index_pattern = os.environ.get("ELB_INDEX_PATTERN", "logs-platform-%Y.%m.%d")
     fetch_mode = os.environ["ELB_INGESTOR_FETCH_MODE"]
-    if fetch_mode == "bad_aggressive_fetcher_do_not_use_until_we_fix_backoff":
+    if fetch_mode in (
+        "bad_aggressive_fetcher_do_not_use_until_we_fix_backoff",
+        "bad_aggressive_async_fetcher_do_not_use_until_we_fix_backoff",
+    ):
         bucket_name = os.environ["ELB_INGESTOR_BUCKET"]
         unprocessed_prefix = os.environ.get("ELB_INGESTOR_SEARCH_PREFIX", "logs/")
         processing_prefix = os.environ.get("ELB_INGESTOR_WORKING_PREFIX", "logs-working/")
         processed_prefix = os.environ.get("ELB_INGESTOR_DONE_PREFIX", "logs-done/")
-        fetcher = elb_log_fetcher.S3LogFetcher(
-            bucket_name,
+        relist_interval = float(os.environ.get("ELB_INGESTOR_RELIST_INTERVAL", 10))
+        # every file in a batch can have up to 8 ranged GETs in flight, so make sure
+        # the connection pool is big enough that they don't queue up behind each other
+        s3_config_options = dict(
+            max_pool_connections=max(64, file_batch_size * 8),
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True,
+        )
+        s3_config = botocore.config.Config(**s3_config_options)
+        s3_client = boto3.client("s3", config=s3_config)
+        bucket = boto3.resource("s3", config=s3_config).Bucket(bucket_name)
+        if fetch_mode.startswith("bad_aggressive_async"):
+            fetcher_class = elb_log_fetcher.AsyncS3LogFetcher
+            # the async fetcher builds its own client, so give it the same settings
+            fetcher_options = dict(s3_config_options=s3_config_options)
+        else:
+            fetcher_class = elb_log_fetcher.S3LogFetcher
+            fetcher_options = dict()
+        fetcher = fetcher_class(
+            bucket,
+            s3_client,
             to_do=logs_to_be_processed,
             done=logs_processed,
             file_batch_size=file_batch_size,
             unprocessed_prefix=unprocessed_prefix,
             processing_prefix=processing_prefix,
             processed_prefix=processed_prefix,
+            relist_interval=relist_interval,
+            **fetcher_options,
         )
     elif fetch_mode == "local_file":
         input_dir = pathlib.Path(os.environ["ELB_INGESTOR_INPUT_DIR"])
@@ -62,30 +93,44 @@ def start_server():
     else:
         raise Exception("No valid fetch mode found!")
 
+    # records carries (id, serialized document, timestamp) tuples - the parser
+    # encodes each document to JSON once, so the shippers don't have to
     parser = elb_log_parse.LogParser(
-        logs_to_be_processed, logs_processed, records, parser_stats
-    )
-    shipper = elasticsearch_shipper.ElasticsearchShipper(
-        #es_client, records, index_pattern, shipper_stats
-        None, records, index_pattern, shipper_stats
+        logs_to_be_processed,
+        logs_processed,
+        records,
+        parser_stats,
+        serializer=orjson.dumps,
     )
+    # one shipper per thread, so none of them share per-shipper state. They all
+    # pull from the same records queue
+    shippers = [
+        elasticsearch_shipper.ElasticsearchShipper(
+            es_client, records, index_pattern, shipper_stats
+        )
+        for _ in range(shipper_count)
+    ]
 
     # prepare the ApiEndpoint class for use
     api_endpoint.ApiEndpoint.parser_stats = parser_stats 
     api_endpoint.ApiEndpoint.shipper_stats = shipper_stats
     api_endpoint.ApiEndpoint.fetcher = fetcher
-    api_endpoint.ApiEndpoint.shipper = shipper
+    api_endpoint.ApiEndpoint.shippers = shippers
 
-    server = http.server.HTTPServer(server_address, api_endpoint.ApiEndpoint)
+    # threaded, so a slow request can't hold up health checks
+    server = http.server.ThreadingHTTPServer(server_address, api_endpoint.ApiEndpoint)
 
     fetcher_thread = threading.Thread(target=fetcher.run, daemon=True)
     parser_thread = threading.Thread(target=parser.run, daemon=True)
-    shipper_thread = threading.Thread(target=shipper.run, daemon=True)
+    shipper_threads = [
+        threading.Thread(target=shipper.run, daemon=True) for shipper in shippers
+    ]
     server_thread = threading.Thread(target=server.serve_forever)
 
     fetcher_thread.start()
     parser_thread.start()
-    shipper_thread.start()
+    for shipper_thread in shipper_threads:
+        shipper_thread.start()
     server_thread.start()
 
 
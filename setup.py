@@ -18,7 +18,8 @@ setup(
     entry_points={
         "console_scripts": "elb_log_ingestor=elb_log_ingestor.main:start_server"
     },
-    install_requires=["boto3", "elasticsearch>=6.0.0,<7.0.0"],
+    install_requires=["boto3", "elasticsearch>=6.0.0,<7.0.0", "orjson"],
+    extras_require={"async": ["aiobotocore"]},
     setup_requires=["pytest_runner"],
     tests_require=open("requirements-dev.txt", "r").read().strip().split("\n"),
     classifiers=[
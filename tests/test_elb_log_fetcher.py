@@ -0,0 +1,311 @@
+import asyncio
+import gzip
+import queue
+
+import pytest
+
+import elb_log_ingestor.elb_log_fetcher
+
+
+@pytest.mark.parametrize("logname,old_prefix,new_prefix,expected",
+[
+    ("logs/foo.log", "logs/", "logs-working/", "logs-working/foo.log"),
+    # only the prefix is replaced, not later occurrences
+    ("logs/logs/foo.log", "logs/", "done/", "done/logs/foo.log"),
+    ("logs/foo.log", "", "done/", "done/logs/foo.log"),
+])
+def test_replace_prefix(logname, old_prefix, new_prefix, expected):
+    assert elb_log_ingestor.elb_log_fetcher.replace_prefix(logname, old_prefix, new_prefix) == expected
+
+
+def test_replace_prefix_rejects_wrong_prefix():
+    with pytest.raises(ValueError):
+        elb_log_ingestor.elb_log_fetcher.replace_prefix("other/foo.log", "logs/", "done/")
+
+
+class FakeBucket:
+    """
+    Just enough of a boto3 Bucket, backed by a dict of key -> bytes
+    """
+
+    name = "bucket"
+
+    def __init__(self, objects):
+        self.objects = dict(objects)
+
+    def copy(self, source, key):
+        self.objects[key] = self.objects[source["Key"]]
+
+    def delete_objects(self, Delete):
+        for obj in Delete["Objects"]:
+            self.objects.pop(obj["Key"], None)
+        return {}
+
+    def download_fileobj(self, key, fileobj, Config=None):
+        fileobj.write(self.objects[key])
+
+
+class FakeS3Client:
+    """
+    Just enough of a boto3 s3 client to list a FakeBucket
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, PaginationConfig):
+        keys = sorted(key for key in self.bucket.objects if key.startswith(Prefix))
+        return [{"Contents": [{"Key": key} for key in keys]}]
+
+
+def make_fetcher(bucket, **kwargs):
+    return elb_log_ingestor.elb_log_fetcher.S3LogFetcher(
+        bucket,
+        FakeS3Client(bucket),
+        queue.Queue(),
+        queue.Queue(),
+        unprocessed_prefix="logs/",
+        processing_prefix="logs-working/",
+        processed_prefix="logs-done/",
+        **kwargs,
+    )
+
+
+def make_async_fetcher(bucket, **kwargs):
+    return elb_log_ingestor.elb_log_fetcher.AsyncS3LogFetcher(
+        bucket,
+        None,
+        queue.Queue(),
+        queue.Queue(),
+        unprocessed_prefix="logs/",
+        processing_prefix="logs-working/",
+        processed_prefix="logs-done/",
+        **kwargs,
+    )
+
+
+def queued_logs(fetcher):
+    logs = {}
+    while not fetcher.to_do.empty():
+        name, lines = fetcher.to_do.get()
+        logs[name] = list(lines)
+    return logs
+
+
+def test_enqueue_log_keeps_the_rest_of_a_batch_when_one_fails():
+    class FlakyBucket(FakeBucket):
+        def copy(self, source, key):
+            if source["Key"] == "logs/b.log":
+                raise Exception("NoSuchKey")
+            super().copy(source, key)
+
+    bucket = FlakyBucket({"logs/a.log": b"a\n", "logs/b.log": b"b\n", "logs/c.log": b"c\n"})
+    fetcher = make_fetcher(bucket)
+    fetcher.enqueue_log(3)
+    assert queued_logs(fetcher) == {"logs-working/a.log": ["a\n"], "logs-working/c.log": ["c\n"]}
+    assert not fetcher.healthy
+
+
+def test_failed_download_leaves_the_log_unprocessed():
+    class BrokenBucket(FakeBucket):
+        def download_fileobj(self, key, fileobj, Config=None):
+            raise Exception("connection reset")
+
+    bucket = BrokenBucket({"logs/a.log": b"a\n"})
+    fetcher = make_fetcher(bucket)
+    fetcher.enqueue_log(1)
+    assert fetcher.to_do.empty()
+    assert not fetcher.healthy
+    assert not fetcher.is_moved("logs/a.log")
+    fetcher.flush_deletes()
+    assert sorted(bucket.objects) == ["logs/a.log"]
+
+
+def test_async_failed_download_leaves_the_log_unprocessed():
+    class BrokenS3Client(FakeAsyncS3Client):
+        async def get_object(self, Bucket, Key):
+            raise Exception("connection reset")
+
+    bucket = FakeBucket({"logs/a.log": b"a\n"})
+    fetcher = make_async_fetcher(bucket)
+    asyncio.run(fetcher.enqueue_log_async(BrokenS3Client(bucket), 1))
+    assert fetcher.to_do.empty()
+    assert not fetcher.healthy
+    assert not fetcher.is_moved("logs/a.log")
+    fetcher.flush_deletes()
+    assert sorted(bucket.objects) == ["logs/a.log"]
+
+
+def test_flush_deletes_retries_keys_s3_failed_to_delete():
+    class StubbornBucket(FakeBucket):
+        def delete_objects(self, Delete):
+            super().delete_objects(
+                {"Objects": [o for o in Delete["Objects"] if o["Key"] != "logs/b.log"]}
+            )
+            return {"Errors": [{"Key": "logs/b.log", "Message": "Access Denied"}]}
+
+    bucket = StubbornBucket({"logs/a.log": b"a\n", "logs/b.log": b"b\n"})
+    fetcher = make_fetcher(bucket)
+    fetcher.queue_delete("logs/a.log")
+    fetcher.queue_delete("logs/b.log")
+    fetcher.flush_deletes()
+    assert not fetcher.healthy
+    # deleted, so we stop tracking it once a fresh listing starts
+    assert fetcher.start_listing(fetcher.list_unprocessed_logs)
+    assert not fetcher.is_moved("logs/a.log")
+    # still in the bucket, so it must stay hidden from listings and queued for retry
+    assert fetcher.is_moved("logs/b.log")
+    assert list(fetcher.unprocessed_keys) == []
+    assert fetcher._pending_deletes == ["logs/b.log"]
+
+
+def test_download_log_handles_ranges_written_out_of_order():
+    # like s3transfer's ranged GETs, which seek() and write() chunks as they arrive
+    class RangedBucket(FakeBucket):
+        def download_fileobj(self, key, fileobj, Config=None):
+            data = self.objects[key]
+            middle = len(data) // 2
+            fileobj.seek(middle)
+            fileobj.write(data[middle:])
+            fileobj.seek(0)
+            fileobj.write(data[:middle])
+
+    lines = [f"line {i}\n" for i in range(200)]
+    bucket = RangedBucket({"logs-working/a.log.gz": gzip.compress("".join(lines).encode())})
+    fetcher = make_fetcher(bucket)
+    name, downloaded = fetcher.download_log("logs-working/a.log.gz")
+    assert list(downloaded) == lines
+
+
+def test_log_names_move_through_each_prefix():
+    fetcher = make_fetcher(FakeBucket({}))
+    processing_name = fetcher.processing_name_from_unprocessed_name("logs/2019/foo.log")
+    assert processing_name == "logs-working/2019/foo.log"
+    processed_name = fetcher.processed_name_from_processing_name(processing_name)
+    assert processed_name == "logs-done/2019/foo.log"
+
+
+def test_local_fetcher_only_splits_lines_on_newlines(tmp_path):
+    input_dir, processing_dir, done_dir = (tmp_path / name for name in ("in", "processing", "done"))
+    for directory in (input_dir, processing_dir, done_dir):
+        directory.mkdir()
+    (input_dir / "a.log").write_text("agent\x1cwith separators\nsecond\n", encoding="utf-8")
+    fetcher = elb_log_ingestor.elb_log_fetcher.LocalLogFetcher(
+        input_dir, processing_dir, done_dir, queue.Queue(), queue.Queue()
+    )
+    fetcher.enqueue_log(1)
+    name, lines = fetcher.to_do.get_nowait()
+    assert name == processing_dir / "a.log"
+    assert list(lines) == ["agent\x1cwith separators\n", "second\n"]
+
+
+@pytest.mark.parametrize("key,contents,expected",
+[
+    # compressed logs are found by their contents, not their names
+    ("logs-working/a.log.gz", gzip.compress(b"one\ntwo\n"), ["one\n", "two\n"]),
+    ("logs-working/a.log", gzip.compress(b"one\ntwo\n"), ["one\n", "two\n"]),
+    ("logs-working/a.log", b"one\ntwo\n", ["one\n", "two\n"]),
+    # a bare \r inside a line doesn't split it
+    ("logs-working/a.log", b"one\rstill one\ntwo\n", ["one\rstill one\n", "two\n"]),
+    ("logs-working/a.log.gz", gzip.compress(b"one\rstill one\ntwo\n"), ["one\rstill one\n", "two\n"]),
+])
+def test_download_log_gunzips_compressed_logs(key, contents, expected):
+    fetcher = make_fetcher(FakeBucket({key: contents}))
+    name, lines = fetcher.download_log(key)
+    assert name == key
+    assert list(lines) == expected
+
+
+def test_listing_skips_logs_deleted_after_their_page_was_fetched():
+    bucket = FakeBucket({"logs/a.log": b"a\n", "logs/b.log": b"b\n", "logs/c.log": b"c\n"})
+    fetcher = make_fetcher(bucket)
+    fetcher.fetch_log("logs/c.log")
+    # the page, which still lists c, is fetched for this batch...
+    fetcher.enqueue_log(1)
+    # ...and c's source is deleted before the listing gets to it
+    fetcher.flush_deletes()
+    fetcher.enqueue_log(5)
+    assert queued_logs(fetcher) == {"logs-working/a.log": ["a\n"], "logs-working/b.log": ["b\n"]}
+    assert fetcher.healthy
+
+
+def test_relisting_waits_only_after_a_listing_finds_nothing():
+    bucket = FakeBucket({"logs/a.log": b"a\n", "logs/b.log": b"b\n"})
+    fetcher = make_fetcher(bucket, relist_interval=60)
+    # the listing runs out exactly on a batch boundary...
+    fetcher.enqueue_log(2)
+    assert fetcher.to_do.qsize() == 2
+    fetcher.enqueue_log(2)
+    # ...but it found logs, so we shouldn't hold off on the next one
+    assert fetcher.next_listing_time == 0.0
+    fetcher.flush_deletes()
+    # this listing finds nothing, so now we wait
+    fetcher.enqueue_log(2)
+    assert fetcher.next_listing_time > 0.0
+
+
+class FakeAsyncBody:
+    """
+    Just enough of an aiobotocore StreamingBody
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+class FakeAsyncS3Client:
+    """
+    Just enough of an aiobotocore s3 client, working on a FakeBucket
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_paginator(self, operation):
+        return self
+
+    async def paginate(self, Bucket, Prefix, PaginationConfig):
+        keys = sorted(key for key in self.bucket.objects if key.startswith(Prefix))
+        yield {"Contents": [{"Key": key} for key in keys]}
+
+    async def copy_object(self, Bucket, Key, CopySource):
+        self.bucket.copy(CopySource, Key)
+
+    async def get_object(self, Bucket, Key):
+        return {"Body": FakeAsyncBody(self.bucket.objects[Key])}
+
+    async def delete_object(self, Bucket, Key):
+        self.bucket.objects.pop(Key, None)
+
+
+def test_async_fetcher_enqueues_logs():
+    class FlakyBucket(FakeBucket):
+        def copy(self, source, key):
+            if source["Key"] == "logs/b.log":
+                raise Exception("NoSuchKey")
+            super().copy(source, key)
+
+    bucket = FlakyBucket({
+        "logs/a.log": b"a\n",
+        "logs/b.log": b"b\n",
+        "logs/c.log.gz": gzip.compress(b"c\n"),
+    })
+    fetcher = make_async_fetcher(bucket)
+    asyncio.run(fetcher.enqueue_log_async(FakeAsyncS3Client(bucket), 3))
+    assert queued_logs(fetcher) == {"logs-working/a.log": ["a\n"], "logs-working/c.log.gz": ["c\n"]}
+    assert not fetcher.healthy
+    fetcher.flush_deletes()
+    assert sorted(bucket.objects) == ["logs-working/a.log", "logs-working/c.log.gz", "logs/b.log"]
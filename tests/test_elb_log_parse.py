@@ -1,7 +1,10 @@
+import gzip
+import io
 import json
 import pathlib
 import queue
 
+import orjson
 import pytest
 
 import elb_log_ingestor.elb_log_parse
@@ -52,6 +55,39 @@ def test_parse_logs(log_file):
     assert sorted(contents, key=lambda x: x['@raw']) == sorted(expected_contents, key=lambda x: x['@raw'])
 
 
+def test_parse_logs_serialized(log_file):
+    logfile, expected = log_file
+    expected_contents =  read_json_file(expected)
+    record_out_queue = ListQueue()
+    stats_parser = elb_log_ingestor.stats.ParserStats()
+    parser = elb_log_ingestor.elb_log_parse.LogParser(ListQueue(), ListQueue(), record_out_queue, stats_parser, serializer=orjson.dumps)
+    with open(logfile) as f:
+        strings = f.readlines()
+    parser.parse_alb_logs(logfile.name, strings)
+    contents = [json.loads(x[1]) for x in record_out_queue.list_]
+    assert sorted(contents, key=lambda x: x['@raw']) == sorted(expected_contents, key=lambda x: x['@raw'])
+    assert [x[2] for x in record_out_queue.list_] == [x['@timestamp'] for x in contents]
+
+
+@pytest.mark.parametrize("contents",
+[
+    b"\xff\xfe not utf-8\n",
+    gzip.compress(b"some log lines\n")[:-8],  # truncated
+])
+def test_parse_file_survives_unreadable_logs(contents):
+    file_out_queue = ListQueue()
+    stats_parser = elb_log_ingestor.stats.ParserStats()
+    parser = elb_log_ingestor.elb_log_parse.LogParser(ListQueue(), file_out_queue, ListQueue(), stats_parser)
+    if contents.startswith(b"\x1f\x8b"):
+        lines = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(contents)), encoding="utf-8", newline="\n")
+    else:
+        lines = io.TextIOWrapper(io.BytesIO(contents), encoding="utf-8", newline="\n")
+    parser.parse_file("logs-working/a.log", lines)
+    assert file_out_queue.list_ == ["logs-working/a.log"]
+    assert stats_parser.lines_errored == 1
+    assert stats_parser.files_processed == 1
+
+
 class ListQueue:
     """
     add queue interface to a list
@@ -0,0 +1,66 @@
+import queue
+import threading
+
+import pytest
+
+from elb_log_ingestor.fast_queue import FastQueue
+
+
+def test_fifo_order():
+    q = FastQueue()
+    for i in range(5):
+        q.put(i)
+    assert q.qsize() == 5
+    assert [q.get() for _ in range(5)] == [0, 1, 2, 3, 4]
+    assert q.empty()
+
+
+def test_get_times_out_when_empty():
+    q = FastQueue()
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+    with pytest.raises(queue.Empty):
+        q.get(block=False)
+
+
+def test_put_times_out_when_full():
+    q = FastQueue(maxsize=1)
+    q.put("a")
+    assert q.full()
+    with pytest.raises(queue.Full):
+        q.put("b", timeout=0.01)
+    with pytest.raises(queue.Full):
+        q.put("b", block=False)
+
+
+def test_get_waits_for_put():
+    q = FastQueue()
+    results = []
+    getter = threading.Thread(target=lambda: results.append(q.get(timeout=5)))
+    getter.start()
+    q.put("item")
+    getter.join()
+    assert results == ["item"]
+
+
+def test_many_producers_and_consumers():
+    q = FastQueue(maxsize=10)
+    results = []
+    results_lock = threading.Lock()
+
+    def consume():
+        for _ in range(100):
+            item = q.get(timeout=5)
+            with results_lock:
+                results.append(item)
+
+    consumers = [threading.Thread(target=consume) for _ in range(4)]
+    producers = [
+        threading.Thread(target=lambda n=n: [q.put((n, i)) for i in range(100)])
+        for n in range(4)
+    ]
+    for thread in consumers + producers:
+        thread.start()
+    for thread in consumers + producers:
+        thread.join()
+    assert sorted(results) == sorted((n, i) for n in range(4) for i in range(100))